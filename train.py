@@ -6,9 +6,9 @@ from utils import train_validate_model     # train validate function
 from utils import IoU
 
 from utils import load_datasets
-from utils import make_loader
+from utils import make_loader, make_loader_dali
 
-from utils import augmentation
+from utils import augmentation, gpu_augmentation
 
 from models import UNet, segformer
 
@@ -35,23 +35,35 @@ if __name__ == '__main__':
     parser.add_argument('--lr', type=float, default=3e-4, help='maximum learning rate')
     parser.add_argument('--train_batch', type=int, default=4, help='batch size for training data')
     parser.add_argument('--val_batch', type=int, default=2, help='batch size for validation data')
-    parser.add_argument('--train_worker', type=int, default=0, help='number of workers for training data')
-    parser.add_argument('--val_worker', type=int, default=0, help='number of workers for validation data')
+    parser.add_argument('--train_worker', type=int, default=None, help='number of workers for training data; by default derived from the number of cpus and gpus')
+    parser.add_argument('--val_worker', type=int, default=None, help='number of workers for validation data; by default derived from the number of cpus and gpus')
     parser.add_argument('--stop_threshold', type=int, default=-1, help='number of epochs without improvement in validation loss after that the training should be stopped')
     parser.add_argument('--lr_scheduler', type=bool, default=False, help='wether to use the implemented learning rate scheduler or not')
     parser.add_argument('--num_classes', type=int, default=6, help='number of semantic classes of the dataset')
     parser.add_argument('--dataset', choices=['potsdam', 'floodnet'], default='potsdam', help='Dataset the model is applied to and trained on; argument mainly used for visualization purposes')
     parser.add_argument('--patch_size', type=int, default=512, help='size of the image patches the model should be trained on')
+    parser.add_argument('--dali', type=bool, default=False, help='if true, decode, resize, augment and normalize the data on the GPU with NVIDIA DALI (falls back to the default loader if DALI is not installed)')
+    parser.add_argument('--cache_dir', type=str, default=None, help='if given, all images and labels are decoded once into memory mapped files in this directory, which are reused by later runs')
+    parser.add_argument('--in_memory', type=bool, default=False, help='if true, all images and labels are decoded once and kept in RAM instead of being read from disk every epoch')
+    parser.add_argument('--gpu_augment', type=bool, default=False, help='if true, flip and color jitter whole training batches on the GPU with kornia instead of augmenting on the cpu (ignored with --dali or if kornia is not installed)')
+    parser.add_argument('--normalize_on_device', type=bool, default=False, help='if true, training and validation images are loaded as uint8 and normalized on the GPU')
     opt = parser.parse_args()
 
     if opt.augment:
         augment = augmentation
     else:
         augment = None
+    # augment on the GPU instead, the dataloader workers then only decode and resize
+    device_augment = gpu_augmentation() if opt.gpu_augment and not opt.dali else None
+    if device_augment is not None:
+        augment = None
     
     # load dataset and create data loader
-    train_dataset, val_dataset, test_dataset = load_datasets(opt.data_path, random_split = opt.random_split, normalize = opt.normalize, augmentation = augment, classes = opt.dataset, patch_size=opt.patch_size, dataset=opt.norm_dataset)
-    train_loader, val_loader, test_loader = make_loader(train_dataset, val_dataset, test_dataset, opt.train_batch, opt.val_batch, opt.train_worker, opt.val_worker)
+    train_dataset, val_dataset, test_dataset = load_datasets(opt.data_path, random_split = opt.random_split, normalize = opt.normalize, augmentation = augment, classes = opt.dataset, patch_size=opt.patch_size, dataset=opt.norm_dataset, in_memory=opt.in_memory, cache_dir=opt.cache_dir, normalize_on_device=opt.normalize_on_device or device_augment is not None)
+    if opt.dali:
+        train_loader, val_loader, test_loader = make_loader_dali(train_dataset, val_dataset, test_dataset, opt.train_batch, opt.val_batch)
+    else:
+        train_loader, val_loader, test_loader = make_loader(train_dataset, val_dataset, test_dataset, opt.train_batch, opt.val_batch, opt.train_worker, opt.val_worker)
 
     # TODO: check if empty_cache() is necessary 
     torch.cuda.empty_cache()
@@ -108,4 +120,5 @@ if __name__ == '__main__':
     # run model training with given arguments
     _ = train_validate_model(model, N_EPOCHS, modelname, criterion, optimizer, 
                          device, train_loader, val_loader, IoU, 
-                         NUM_CLASSES, lr_scheduler = lr_scheduler, output_path = opt.output_path, early_stop=opt.stop_threshold)
+                         NUM_CLASSES, lr_scheduler = lr_scheduler, output_path = opt.output_path, early_stop=opt.stop_threshold, 
+                         device_augmentation=device_augment)
@@ -1,16 +1,14 @@
 # basic imports
 import os
 import math
-from datetime import datetime
+import contextlib
+import hashlib
+import random
+from datetime import datetime, timedelta
 import cv2
 import numpy as np
-np.set_printoptions(threshold=np.inf)
-import pandas as pd
 from tqdm import tqdm
-import matplotlib.pyplot as plt
-from matplotlib import colors
-from matplotlib.patches import Patch
-from collections import namedtuple
+# matplotlib and pandas are imported in the plotting and result functions to keep importing this module cheap
 from PIL import Image
 
 # DL library imports
@@ -21,11 +19,33 @@ from torchvision import transforms
 from torch.utils.data import Dataset, DataLoader
 from torch.optim.lr_scheduler import _LRScheduler
 
+# optional augmentation library working directly on numpy arrays
+try:
+    import albumentations as A
+except ImportError:
+    A = None
+
+# optional batched augmentation on the GPU
+try:
+    import kornia.augmentation as K
+except ImportError:
+    K = None
+
+# optional JIT compilation of the cpu hot loops
+try:
+    from numba import njit, prange, get_num_threads
+except ImportError:
+    njit = None
+
 
 ###################################
 # FILE CONSTANTS
 ###################################
 
+def enable_full_print():
+    """ Print numpy arrays completely instead of summarized, e.g. to inspect confusion matrices """
+    np.set_printoptions(threshold=np.inf)
+
 # Convert to torch tensor and normalize images using Imagenet values
 preprocess = transforms.Compose([
                     transforms.ToTensor(),
@@ -40,38 +60,145 @@ norms = {
     'vaihingen': {'mean':(0.4731, 0.3206, 0.3182), 'std':(0.1970, 0.1306, 0.1276)},
 }
 
+# (false) imagenet values used if no or an unknown dataset is given
+default_norm = {'mean':(0.485, 0.56, 0.406), 'std':(0.229, 0.224, 0.225)}
+
+# normalizations and their inverse are built once per dataset and reused on every call
+def _normalize(d):
+    return transforms.Normalize(mean=torch.tensor(d['mean']), std=torch.tensor(d['std']))
+
+def _inverse_normalize(d):
+    mean, std = np.array(d['mean']), np.array(d['std'])
+    return transforms.Normalize(torch.tensor(-mean/std, dtype=torch.float32), torch.tensor(1/std, dtype=torch.float32))
+
+_NORMS = {name: _normalize(d) for name, d in norms.items()}
+_DEFAULT_NORM = _normalize(default_norm)
+_INV_NORMS = {name: _inverse_normalize(d) for name, d in norms.items()}
+_DEFAULT_INV_NORM = _inverse_normalize(default_norm)
+
+# float32 (mean, std) arrays per dataset, shared by all Dataset instances and the on device normalization
+def _norm_stats(d):
+    return np.array(d['mean'], dtype=np.float32), np.array(d['std'], dtype=np.float32)
+
+_NORM_STATS = {name: _norm_stats(d) for name, d in norms.items()}
+_DEFAULT_NORM_STATS = _norm_stats(default_norm)
+# without normalization images are only scaled to [0, 1]
+_IDENTITY_NORM_STATS = _norm_stats({'mean':(0., 0., 0.), 'std':(1., 1., 1.)})
+
+# arrays to normalize uint8 images on the cpu (see Dataset._to_tensor), built once per (mean, std)
+_NORM_LUTS = {}
+
+def _norm_luts(stats):
+    """ Per channel 255 * mean, 1 / (255 * std) and the normalized value of every uint8 value, 
+    lut[c, v] = (v/255 - mean[c]) / std[c], for the (mean, std) arrays stats """
+    mean, std = stats
+    key = (mean.tobytes(), std.tobytes())
+    if key not in _NORM_LUTS:
+        mean_f32 = (255 * mean).reshape(3, 1, 1)
+        inv_std_f32 = (1 / (255 * std)).reshape(3, 1, 1)
+        norm_lut = ((np.arange(256, dtype=np.float32) - mean_f32.reshape(3, 1)) * inv_std_f32.reshape(3, 1)).astype(np.float32)
+        _NORM_LUTS[key] = (mean_f32, inv_std_f32, norm_lut)
+    return _NORM_LUTS[key]
+
 def normalize_images(dataset):
-    if dataset in norms.keys():
-        return transforms.Compose([
-                    transforms.Normalize(mean=np.array(norms[dataset]['mean']), std=np.array(norms[dataset]['std'])) # Image Net mean and std
-                ])
-    else:
-        return transforms.Compose([
-                    transforms.Normalize(mean=(0.485, 0.56, 0.406), std=(0.229, 0.224, 0.225)) # Image Net mean and std
-                ])
+    return _NORMS.get(dataset, _DEFAULT_NORM)
+
+# albumentations works on the uint8 numpy arrays, the torchvision fallback needs a PIL image per sample
+if A is not None:
+    augmentation = A.Compose([
+        A.ColorJitter(
+            brightness=0.5, 
+            contrast=1, 
+            saturation=0.1, 
+            hue=0.5, 
+            p=1.0 # always applied, like the torchvision ColorJitter
+        )
+    ])
+else:
+    augmentation = torch.nn.Sequential(
+        # transforms.ToTensor(),
+        transforms.ColorJitter(
+            brightness=0.5, 
+            contrast=1, 
+            saturation=0.1, 
+            hue=0.5
+        )
+    )
 
-augmentation = torch.nn.Sequential(
-    # transforms.ToTensor(),
-    transforms.ColorJitter(
-        brightness=0.5, 
-        contrast=1, 
-        saturation=0.1, 
-        hue=0.5
+def gpu_augmentation():
+    """ Random flips and the color jitter of utils.augmentation as one batched kornia pipeline, 
+    applied to whole batches on the device by CudaPrefetcher (see train_validate_model). 
+    Returns None if kornia is not installed """
+    if K is None:
+        return None
+    return K.AugmentationSequential(
+        K.RandomHorizontalFlip(),
+        K.RandomVerticalFlip(),
+        K.ColorJitter(brightness=0.5, contrast=1., saturation=0.1, hue=0.5, p=1.),
+        data_keys=['input', 'mask']
     )
-)
 
 # when using torch datasets we defined earlier, the output image
 # is normalized. So we're defining an inverse transformation to 
 # transform to normal RGB format
 def inverse_transform(dataset):
-    if dataset in norms.keys():
-        return transforms.Compose([
-            transforms.Normalize(-np.array(norms[dataset]['mean'])/np.array(norms[dataset]['std']), 1/np.array(norms[dataset]['std']))
-    ])
-    else:
-        return transforms.Compose([
-            transforms.Normalize((-0.485/0.229, -0.56/0.224, -0.406/0.225), (1/0.229, 1/0.224, 1/0.225))
-    ])
+    return _INV_NORMS.get(dataset, _DEFAULT_INV_NORM)
+
+
+
+###################################
+# NUMBA KERNELS (ONLY IF NUMBA IS INSTALLED)
+###################################
+
+if njit is not None:
+    # the per sample kernels run inside the dataloader workers, which already provide the parallelism; 
+    # they are compiled without parallel=True, so no thread pool is started per worker and forking workers 
+    # after a kernel ran in the main process is safe (the GNU OpenMP threading layer is not fork safe)
+    @njit(cache=True)
+    def _pack_and_map(label, keys, values):
+        """ Map a HxWx3 uint8 label image to class ids in one pass; 
+        packs every pixel and searches the few known colors linearly, unknown colors get class 0 """
+        h, w = label.shape[0], label.shape[1]
+        label_seg = np.zeros((h, w), dtype=np.uint8)
+        for y in range(h):
+            for x in range(w):
+                packed = np.int64(label[y, x, 0]) * 65536 + np.int64(label[y, x, 1]) * 256 + np.int64(label[y, x, 2])
+                for j in range(keys.shape[0]):
+                    if keys[j] == packed:
+                        label_seg[y, x] = values[j]
+                        break
+        return label_seg
+
+    # only called in the main process on whole batches
+    @njit(parallel=True, cache=True)
+    def _fast_hist_nb(label_true, label_pred, num_classes):
+        """ Confusion matrix of flat label arrays with one partial histogram per thread """
+        n = label_true.shape[0]
+        n_bins = num_classes * num_classes
+        n_threads = get_num_threads()
+        chunk = (n + n_threads - 1) // n_threads
+        partial = np.zeros((n_threads, n_bins), dtype=np.int64)
+        for t in prange(n_threads):
+            for i in range(t * chunk, min(n, (t + 1) * chunk)):
+                k = label_true[i] * num_classes + label_pred[i]
+                # numba does not check bounds, skip invalid labels instead of writing out of range
+                if k >= 0 and k < n_bins:
+                    partial[t, k] += 1
+        return partial.sum(axis=0).reshape(num_classes, num_classes)
+
+    @njit(cache=True)
+    def _normalize_nb(image, lut, bgr, out):
+        """ Write the normalized values of a HxWx3 uint8 image to the 3xHxW float32 array out, 
+        looking them up per channel in lut (3x256); channels are reversed if bgr """
+        h, w = image.shape[0], image.shape[1]
+        for y in range(h):
+            for x in range(w):
+                for c in range(3):
+                    out[c, y, x] = lut[c, image[y, x, 2 - c if bgr else c]]
+else:
+    _pack_and_map = None
+    _fast_hist_nb = None
+    _normalize_nb = None
 
 
 
@@ -86,19 +213,21 @@ class IoU:
         self.num_classes = num_classes
         # placeholder for confusion matrix on entire dataset
         self.confusion_matrix = np.zeros((self.num_classes, self.num_classes))
+        # confusion matrix accumulated on the device of the predictions, see update_gpu
+        self.cm_gpu = None
         
     def _fast_hist(self, label_true, label_pred):
-        """ Function to calculate confusion matrix on single batch """
-        # mask only valid labels (this step should be irrelevant usually)
-        mask = (label_true >= 0) & (label_true < self.num_classes)
+        """ Function to calculate confusion matrix on single batch (cpu fallback of update_gpu) 
+        Expects labels in the range [0, num_classes), which the Dataset guarantees """
         # calculate correctness of segementation by assigning numbers and count them
         # e.g. for 6 classes [0:5], 
             # 7 is a class 2 pixel segemented correctly (6*1+1)
             # 16 is a class 3 pixel segmented as class 5 (6*2+4)
-        hist = np.bincount(
-            self.num_classes * label_true[mask].astype(int) + label_pred[mask],
-            minlength=self.num_classes ** 2,
-        ).reshape(self.num_classes, self.num_classes)
+        if _fast_hist_nb is not None:
+            return _fast_hist_nb(label_true.ravel(), label_pred.ravel(), self.num_classes)
+        k = self.num_classes * label_true.astype(np.int32, copy=False)
+        k += label_pred.astype(np.int32, copy=False)
+        hist = np.bincount(k.ravel(), minlength=self.num_classes ** 2).reshape(self.num_classes, self.num_classes)
         return hist
 
     def update(self, y_preds, labels):
@@ -107,9 +236,27 @@ class IoU:
         predicted_labels = torch.argmax(y_preds, dim=1)
         batch_confusion_matrix = self._fast_hist(labels.numpy().flatten(), predicted_labels.numpy().flatten())
         self.confusion_matrix += batch_confusion_matrix
+
+    def update_gpu(self, pred_labels, labels):
+        """ Function adds the confusion matrix of the input batch to a matrix kept on the device 
+        of the inputs, so that no copy to the host is necessary per batch. 
+        Expects predicted class ids (e.g. y_preds.argmax(1)) instead of the model output """
+        n = self.num_classes ** 2
+        if self.cm_gpu is None:
+            # flattened matrix plus one bin collecting invalid labels
+            self.cm_gpu = torch.zeros(n + 1, dtype=torch.int64, device=labels.device)
+        # route invalid labels to the extra bin instead of masking them out, 
+        # boolean indexing and torch.bincount would both sync with the host
+        valid = (labels >= 0) & (labels < self.num_classes)
+        k = torch.where(valid, labels * self.num_classes + pred_labels, torch.full_like(labels, n)).flatten()
+        self.cm_gpu.index_add_(0, k, torch.ones_like(k))
     
     def compute(self, matrix = None):
         """ Computes overall meanIoU metric from confusion matrix data """ 
+        if self.cm_gpu is not None:
+            # single copy of the matrix accumulated on the device
+            self.confusion_matrix += self.cm_gpu[:-1].view(self.num_classes, self.num_classes).cpu().numpy()
+            self.cm_gpu = None
         hist = self.confusion_matrix
         # if a matrix is given as argument to the function, compute the metrices based on that matrix 
         if matrix:
@@ -134,6 +281,7 @@ class IoU:
     def reset(self):
         self.iou_metric = 0.0
         self.confusion_matrix = np.zeros((self.num_classes, self.num_classes))
+        self.cm_gpu = None
         
 
 
@@ -142,6 +290,8 @@ class IoU:
 ###################################
 
 def plot_training_results(df, model_name):
+    import matplotlib.pyplot as plt
+    import pandas as pd
     fig, ax1 = plt.subplots(figsize=(10,4))
     ax1.set_ylabel('trainLoss', color='tab:red')
     ax1.plot(df['epoch'].values, df['trainLoss'].values, color='tab:red')
@@ -155,7 +305,8 @@ def plot_training_results(df, model_name):
     ax3 = ax1.twinx()  
     ax3.set_ylabel('trainingTime(sec)', color='tab:orange', labelpad=-32)
     ax3.tick_params(axis="y",direction="in", pad=-23)
-    ax3.plot(df['epoch'].values, df['duration_train'].dt.total_seconds(), color='tab:orange')
+    # checkpoints store the durations in seconds, results of the current run as timedelta
+    ax3.plot(df['epoch'].values, pd.to_timedelta(df['duration_train'], unit='s').dt.total_seconds(), color='tab:orange')
     ax3.tick_params(axis='y', labelcolor='tab:orange')
 
     plt.suptitle(f'{model_name} Training, Validation Curves')
@@ -164,27 +315,130 @@ def plot_training_results(df, model_name):
 
 
 
+###################################
+# PREFETCHER TO OVERLAP HOST TO DEVICE COPIES WITH COMPUTE
+###################################
+
+class CudaPrefetcher:
+    """ Wraps a dataloader and copies the next batch to the device on a separate cuda stream 
+    while the current batch is processed. On cpu devices the batches are simply moved to the device. 
+    Use a dataloader with pin_memory=True, otherwise the copies cannot run asynchronously. 
+    uint8 images of datasets with normalize_on_device are scaled and normalized on the device after the copy, 
+    an augmentation (e.g. gpu_augmentation()) is applied to these batches in between. """
+    def __init__(self, dataloader, device, augmentation=None):
+        self.dataloader = dataloader
+        self.augmentation = augmentation
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.next_batch = None
+        dataset = getattr(dataloader, 'dataset', None)
+        if isinstance(dataset, torch.utils.data.Subset):
+            dataset = dataset.dataset
+        self.mean, self.std = None, None
+        if getattr(dataset, 'normalize_on_device', False):
+            self.mean = torch.from_numpy(dataset._mean).to(self.device).view(1, -1, 1, 1)
+            self.std = torch.from_numpy(dataset._std).to(self.device).view(1, -1, 1, 1)
+        elif augmentation is not None:
+            # color transforms expect images in [0, 1], not normalized ones
+            raise ValueError("augmentation on the device needs a dataset with normalize_on_device=True")
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        self._iterator = iter(self.dataloader)
+        self._preload()
+        return self
+
+    def _preload(self):
+        """ Start copying the next batch to the device """
+        try:
+            inputs, labels = next(self._iterator)
+        except StopIteration:
+            self.next_batch = None
+            return
+        if self.stream is None:
+            self.next_batch = self._normalize(inputs.to(self.device), labels.to(self.device))
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = self._normalize(inputs.to(self.device, non_blocking=True), labels.to(self.device, non_blocking=True))
+
+    def _normalize(self, inputs, labels):
+        """ Scale a uint8 batch to [0, 1], augment it and normalize it in place on the device """
+        if self.mean is None or inputs.dtype != torch.uint8:
+            return inputs, labels
+        inputs = inputs.float().div_(255)
+        if self.augmentation is not None:
+            # kornia expects float masks with a channel dimension
+            inputs, masks = self.augmentation(inputs, labels.unsqueeze(1).float())
+            labels = masks.squeeze(1).round_().long()
+        return inputs.sub_(self.mean).div_(self.std), labels
+
+    def __next__(self):
+        if self.stream is not None:
+            # make sure the copy of the batch has finished before it is used
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+        batch = self.next_batch
+        if batch is None:
+            raise StopIteration
+        if self.stream is not None:
+            # tensors were allocated on the side stream, tell the allocator they are used on the compute stream
+            for tensor in batch:
+                tensor.record_stream(torch.cuda.current_stream(self.device))
+        self._preload()
+        return batch
+
+
+
 ###################################
 # FUNCTION TO EVALUATE MODEL ON DATALOADER
 ###################################
 
+def _compile_model(model, device):
+    """ Compile the model with torch.compile (PyTorch >= 2.0) on cuda devices; 
+    models on other devices and already compiled models are returned unchanged """
+    if torch.device(device).type != 'cuda' or not hasattr(torch, 'compile') or hasattr(model, '_orig_mod'):
+        return model
+    return torch.compile(model, mode='reduce-overhead', fullgraph=False)
+
+
+def _autocast(device, dtype, enabled):
+    """ Mixed precision context for the forward pass; PyTorch < 1.10 has no torch.autocast 
+    and only supports float16 with torch.cuda.amp.autocast """
+    if not enabled:
+        return contextlib.nullcontext()
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device.type, dtype=dtype)
+    return torch.cuda.amp.autocast()
+
+
 def evaluate_model(
         model : torch.nn.Module, 
         dataloader : torch.utils.data.Dataloader, 
         criterion, 
         metric_class, 
         num_classes : int, 
-        device : torch.device
+        device : torch.device,
+        channels_last : bool = False,
+        verbose : bool = False,
+        compile_model : bool = False
         ):
     """Evaluate a model on given data
 
+    Inputs and labels are copied to the device on a separate stream by CudaPrefetcher, which only overlaps 
+    with compute if the dataloader is built with pin_memory=True, 
+    e.g. DataLoader(..., pin_memory=True, persistent_workers=True, num_workers=4, prefetch_factor=4).
+
     Args:
         model (torch.nn.Module): Model to train; either of class UNet or segformer
         criterion (): loss function, e.g. smp.losses.JaccardLoss
         metric_class (_type_): metrics to evaluate the model
-        dataloader (torch.utils.data.Dataloader): dataloader for test data
+        dataloader (torch.utils.data.Dataloader): dataloader for test data, preferably with pin_memory=True
         num_classes (int): number of semantic classes
         device (torch.device): device to train on; e.g. "cuda:0" or "cpu"
+        channels_last (bool, optional): If true, run model and inputs in channels_last memory format, which enables faster NHWC cuDNN kernels for CNNs like the UNet. Defaults to False.
+        verbose (bool, optional): If true, print number of batches and total loss. Defaults to False.
+        compile_model (bool, optional): If true and evaluating on a cuda device, compile the model with torch.compile unless it is compiled already. Defaults to False.
 
     Returns:
         _type_: evaluation metrics
@@ -193,22 +447,28 @@ def evaluate_model(
     model.eval()
     total_loss = 0.0
     metric_object = metric_class(num_classes)
-
-    with torch.no_grad():
-        for inputs, labels in tqdm(dataloader, total=len(dataloader)):
-            inputs = inputs.to(device)
-            labels = labels.to(device)                
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if compile_model:
+        model = _compile_model(model, device)
+
+    with torch.inference_mode():
+        for inputs, labels in tqdm(CudaPrefetcher(dataloader, device), total=len(dataloader)):
+            if channels_last:
+                inputs = inputs.contiguous(memory_format=torch.channels_last)
             y_preds = model(inputs)
 
-            # calculate loss
+            # calculate loss; keep it on the device to avoid a sync per batch
             loss = criterion(y_preds, labels)
-            total_loss += loss.item()
+            total_loss += loss.detach()
 
-            # update batch metric information            
-            metric_object.update(y_preds.cpu().detach(), labels.cpu().detach())
+            # update batch metric information on the device
+            metric_object.update_gpu(torch.argmax(y_preds, dim=1), labels)
             
-    print(len(dataloader))
-    print(total_loss)
+    total_loss = float(total_loss)
+    if verbose:
+        print(len(dataloader))
+        print(total_loss)
 
     evaluation_loss = total_loss / len(dataloader)
     evaluation_metric = metric_object.compute()
@@ -220,6 +480,38 @@ def evaluate_model(
 # FUNCTION TO TRAIN, VALIDATE MODEL ON DATALOADER
 ###################################
 
+def _to_builtin(value):
+    """ Convert numpy arrays and scalars, tensors and timedeltas (in seconds) in nested dicts and lists 
+    to plain python types, so checkpoints can be read with torch.load(..., weights_only=True) """
+    if isinstance(value, dict):
+        return {key: _to_builtin(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_builtin(v) for v in value]
+    if isinstance(value, (np.ndarray, torch.Tensor)):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return value
+
+
+def _save_checkpoint(path, model, optimizer, lr_scheduler, scaler, min_val_loss, best_epoch, results, epoch):
+    """ Save only the state dicts of model, optimizer, scheduler and gradient scaler 
+    instead of pickling the whole objects, the results only as plain python types. 
+    Restore a model with model.load_state_dict(checkpoint['model_state_dict']) """
+    torch.save({
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'lr_scheduler_state_dict': lr_scheduler.state_dict() if lr_scheduler else None,
+        'scaler_state_dict': scaler.state_dict() if scaler.is_enabled() else None,
+        'min_val_loss': _to_builtin(min_val_loss),
+        'best_epoch': best_epoch,
+        'results': _to_builtin(results),
+        'epoch': epoch,
+    }, path)
+
+
 def train_validate_model(
         model : torch.nn.Module, 
         num_epochs : int, 
@@ -233,10 +525,16 @@ def train_validate_model(
         num_classes : int, 
         lr_scheduler = None,
         output_path : str = '.', 
-        early_stop : int = -1
+        early_stop : int = -1,
+        mixed_precision : bool = True,
+        compile_model : bool = True,
+        device_augmentation = None
         ):
     """Train and validate a model
 
+    Batches are prefetched to the device by CudaPrefetcher, so both dataloaders should be built 
+    with pin_memory=True, e.g. DataLoader(..., pin_memory=True, persistent_workers=True, num_workers=4, prefetch_factor=4).
+
     Args:
         model (torch.nn.Module): Model to train; either of class UNet or segformer
         num_epochs (int): number of epochs to train
@@ -244,13 +542,16 @@ def train_validate_model(
         criterion (): loss function, e.g. smp.losses.JaccardLoss
         optimizer (torch.optim): Optimizer, e.g. Adam
         device (torch.device): device to train on; e.g. "cuda:0" or "cpu"
-        dataloader_train (torch.utils.data.Dataloader): dataloader for training data
-        dataloader_valid (torch.utils.data.Dataloader): dataloader for validation data
+        dataloader_train (torch.utils.data.Dataloader): dataloader for training data, preferably with pin_memory=True
+        dataloader_valid (torch.utils.data.Dataloader): dataloader for validation data, preferably with pin_memory=True
         metric_class (_type_): metrics to evaluate the model
         num_classes (int): number of semantic classes
         lr_scheduler (_type_, optional): learning rate scheduler; e.g. torch.optim.lr_scheduler.OneCycleLR . Defaults to None.
         output_path (str, optional): Directory to save the model at. Defaults to '.'.
         early_stop (int, optional): Number of epochs for an early stopping of the training. I.e. after the number of epochs given here without an improvement in the validation loss, the training is stopped. Defaults to -1.
+        mixed_precision (bool, optional): If true and training on a cuda device, run forward pass and loss in bfloat16 (if supported by the GPU) or float16 with gradient scaling. Defaults to True.
+        compile_model (bool, optional): If true and training on a cuda device, compile the model with torch.compile. Checkpoints still contain the state dict of the uncompiled model. Defaults to True.
+        device_augmentation (torch.nn.Module, optional): Augmentation applied to each training batch on the device, e.g. utils.gpu_augmentation(). Needs a training dataset with normalize_on_device=True. Defaults to None.
 
     Returns:
         pd.Dataframe: evaluation metrics
@@ -260,6 +561,8 @@ def train_validate_model(
     # initialize placeholders for running values    
     results = []
     min_val_loss = np.Inf
+    best_epoch = -1
+    scaler_state = None
     len_train_loader = len(dataloader_train)
     
     model_folder = os.path.join(output_path, model_name)
@@ -272,28 +575,48 @@ def train_validate_model(
         if os.path.exists(lastmodel_path):
             print('model already exists. load last states..')
             checkpoint = torch.load(lastmodel_path)
-            model.load_state_dict(checkpoint['model'].state_dict())
-            optimizer.load_state_dict(checkpoint['optimizer'].state_dict())
+            model.load_state_dict(checkpoint['model_state_dict'])
+            optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
             if lr_scheduler:
-                lr_scheduler.load_state_dict(checkpoint['lr_scheduler'].state_dict())
+                if checkpoint.get('lr_scheduler_state_dict') is not None:
+                    lr_scheduler.load_state_dict(checkpoint['lr_scheduler_state_dict'])
+                elif checkpoint.get('lr_scheduler') is not None:
+                    # checkpoints of older versions stored the whole scheduler object
+                    lr_scheduler.load_state_dict(checkpoint['lr_scheduler'].state_dict())
+            if checkpoint.get('scaler_state_dict'):
+                scaler_state = checkpoint['scaler_state_dict']
             results = checkpoint['results']
+            if results and 'best_epoch' in checkpoint:
+                min_val_loss = checkpoint['min_val_loss']
+                best_epoch = checkpoint['best_epoch']
             
 
     if results:
         epochs_trained = results[-1]['epoch']+1
-        # get minimum validation loss from previous training
-        min_val_loss = min(results, key=lambda x:x['validationLoss'])['validationLoss'] 
-        best_epoch = min(results, key=lambda x:x['validationLoss'])['epoch'] 
+        if best_epoch == -1:
+            # checkpoints of older versions do not store the best epoch, get minimum validation loss from previous training
+            best_result = min(results, key=lambda x:x['validationLoss'])
+            min_val_loss, best_epoch = best_result['validationLoss'], best_result['epoch']
         print(f"Best epoch: {best_epoch+1}")
         if epochs_trained >= num_epochs:
             print(f"Existing model already trained for at least {num_epochs} epochs")
             return  # terminate the training loop
     else:
         epochs_trained = 0
-        best_epoch = -1
     
     # move model to device
+    device = torch.device(device)
     model.to(device)
+    # the compiled model shares its parameters with model, which is kept to save clean state dicts
+    compiled_model = _compile_model(model, device) if compile_model else model
+
+    # mixed precision: bfloat16 needs no gradient scaling, float16 does
+    use_amp = mixed_precision and device.type == 'cuda'
+    bf16 = use_amp and hasattr(torch, 'autocast') and torch.cuda.is_bf16_supported()
+    amp_dtype = torch.bfloat16 if bf16 else torch.float16
+    scaler = torch.cuda.amp.GradScaler(enabled=(use_amp and amp_dtype == torch.float16))
+    if scaler_state and scaler.is_enabled():
+        scaler.load_state_dict(scaler_state)
     
     for epoch in range(epochs_trained, num_epochs):
         # epoch = epoch + epochs_trained
@@ -302,32 +625,35 @@ def train_validate_model(
         starttime = datetime.now()
         
         # Training
-        model.train()
+        compiled_model.train()
         train_loss = 0.0
-        for inputs, labels in tqdm(dataloader_train, total=len_train_loader):
-            inputs = inputs.to(device)
-            labels = labels.to(device) 
-            
+        for inputs, labels in tqdm(CudaPrefetcher(dataloader_train, device, augmentation=device_augmentation), total=len_train_loader):
+            # clear gradients of the last step; None instead of zeros skips a memset per parameter
+            optimizer.zero_grad(set_to_none=True)
+
             # Forward pass
-            y_preds = model(inputs)
-            loss = criterion(y_preds, labels)
-            train_loss += loss.item()
+            with _autocast(device, amp_dtype, use_amp):
+                y_preds = compiled_model(inputs)
+                loss = criterion(y_preds, labels)
+            # keep the running loss on the device, .item() would sync every iteration
+            train_loss += loss.detach()
               
-            # Backward pass
-            loss.backward()
-            optimizer.step()
-            optimizer.zero_grad()
+            # Backward pass (the scaler is a no-op if disabled)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
             # adjust learning rate
             if lr_scheduler is not None:
                 lr_scheduler.step()
             
         # compute per batch losses, metric value
-        train_loss = train_loss / len(dataloader_train)
+        train_loss = float(train_loss) / len(dataloader_train)
 
         endtime_train = datetime.now()
         validation_loss, validation_metric = evaluate_model(
-                        model, dataloader_valid, criterion, metric_class, num_classes, device)
+                        compiled_model, dataloader_valid, criterion, metric_class, num_classes, device, 
+                        compile_model=compile_model)
         
         endtime_val = datetime.now()
         
@@ -343,33 +669,19 @@ def train_validate_model(
                         'duration_train': duration_training,
                        })
         
-        torch.save({
-            'model': model,
-            'model_state_dict': model.state_dict(),
-            'optimizer': optimizer,
-            'optimizer_state_dict': optimizer.state_dict(),
-            'lr_scheduler': lr_scheduler,
-            # 'scheduler_state_dict': lr_scheduler.state_dict(),
-            'min_val_loss': min_val_loss,
-            'results': results,
-            'epoch': epoch,
-        }, f"{output_path}/{model_name}/{model_name}_last.pt")
-        
-        # if validation loss has decreased, save model and reset variable
-        if validation_loss <= min_val_loss:
+        # track the best epoch incrementally, so resuming does not need to scan all results
+        improved = validation_loss <= min_val_loss
+        if improved:
             min_val_loss = validation_loss
             best_epoch = epoch
-            torch.save({
-                'model': model,
-                # 'model_state_dict': model.state_dict(),
-                'optimizer': optimizer,
-                # 'optimizer_state_dict': optimizer.state_dict(),
-                'lr_scheduler': lr_scheduler,
-                # 'scheduler_state_dict': lr_scheduler.state_dict(),
-                'min_val_loss': min_val_loss,
-                'results': results,
-                'epoch': epoch,
-            }, f"{output_path}/{model_name}/{model_name}_best.pt")
+        
+        _save_checkpoint(f"{output_path}/{model_name}/{model_name}_last.pt", 
+                         model, optimizer, lr_scheduler, scaler, min_val_loss, best_epoch, results, epoch)
+        
+        # if validation loss has decreased, save model
+        if improved:
+            _save_checkpoint(f"{output_path}/{model_name}/{model_name}_best.pt", 
+                             model, optimizer, lr_scheduler, scaler, min_val_loss, best_epoch, results, epoch)
             print('best model saved')
         elif early_stop_threshold != -1:
             if epoch - best_epoch > early_stop_threshold:
@@ -381,6 +693,7 @@ def train_validate_model(
 
 
     # plot results
+    import pandas as pd
     results = pd.DataFrame(results)
     plot_training_results(results, model_name)
     return results
@@ -391,36 +704,38 @@ def train_validate_model(
 ###################################
 
 
+# colormaps of the ISPRS (6 classes) and FloodNet (10 classes) labels, the row index is the class id
+_ID_TO_COLOR_6 = np.array([
+    (255, 255, 255), 
+    (0, 0, 255), 
+    (0, 255, 255), 
+    (0, 255, 0), 
+    (255, 255, 0), 
+    (255, 0, 0), 
+], dtype=np.uint8)
+_ID_TO_COLOR_10 = np.array([
+    (0, 0, 0), 
+    (255, 0, 0), 
+    (200, 90, 90), 
+    (130, 130, 0), 
+    (150, 150, 150), 
+    (0, 255, 255), 
+    (0, 0, 255), 
+    (255, 0, 255), 
+    (250, 250, 0), 
+    (0, 255, 0), 
+], dtype=np.uint8)
+_ID_TO_COLOR = {6: _ID_TO_COLOR_6, 10: _ID_TO_COLOR_10}
+
+# colors of wrong (0) and correct (1) predictions
+_ID_TO_RG = np.array([[200, 0, 0], [0, 250, 0]], dtype=np.uint8)
+
 def train_id_to_color(classes):
-    Label = namedtuple( "Label", [ "name", "train_id", "color"])
-    if len(classes) == 6:
-        drivables = [ 
-            Label(classes[0], 0, (255, 255, 255)), 
-            Label(classes[1], 1, (0, 0, 255)), 
-            Label(classes[2], 2, (0, 255, 255)), 
-            Label(classes[3], 3, (0, 255, 0)), 
-            Label(classes[4], 4, (255, 255, 0)), 
-            Label(classes[5], 5, (255, 0, 0))
-        ]
-    elif len(classes) == 10:
-        drivables = [ 
-            Label(classes[0], 0, (0, 0, 0)), 
-            Label(classes[1], 1, (255, 0, 0)), 
-            Label(classes[2], 2, (200, 90, 90)), 
-            Label(classes[3], 3, (130, 130, 0)), 
-            Label(classes[4], 4, (150, 150, 150)), 
-            Label(classes[5], 5, (0, 255, 255)),
-            Label(classes[6], 6, (0, 0, 255)), 
-            Label(classes[7], 7, (255, 0, 255)), 
-            Label(classes[8], 8, (250, 250, 0)), 
-            Label(classes[9], 9, (0, 255, 0)) 
-        ]
-    else:
+    from matplotlib.patches import Patch
+    id_to_color = _ID_TO_COLOR.get(len(classes))
+    if id_to_color is None:
         return
     
-    id_to_color = [c.color for c in drivables if (c.train_id != -1 and c.train_id != 255)]
-    id_to_color = np.array(id_to_color)
-    
     legend_elements = []
     for i, c in enumerate(classes):
         legend_elements.append(Patch(facecolor=id_to_color[i]/255, label=c))
@@ -437,10 +752,12 @@ def train_id_to_color(classes):
 #     Patch(facecolor=train_id_to_color[5]/255, label=drivables[5].name),
 #                   ]
 
-diff_legend = [
-    Patch(facecolor='#00fa00', label='True'), 
-    Patch(facecolor='#c80000', label='False'), 
-]
+def _diff_legend():
+    from matplotlib.patches import Patch
+    return [
+        Patch(facecolor='#00fa00', label='True'), 
+        Patch(facecolor='#c80000', label='False'), 
+    ]
 
 def visualize_predictions(model : torch.nn.Module, 
                           dataSet : Dataset,  
@@ -468,6 +785,9 @@ def visualize_predictions(model : torch.nn.Module,
         classes : array with classes of the dataset; currently implemented ISPRS and FloodNet datasets with 6 and 10 classes respectively
         model_label (String) : text that should be added to the figure title
     """
+    import matplotlib.pyplot as plt
+    from matplotlib import colors
+
     model.to(device=device)
     model.eval()
 
@@ -483,37 +803,39 @@ def visualize_predictions(model : torch.nn.Module,
     for handle in legend_elements:
         if handle.get_label() == 'Impervious':
             handle.set_edgecolor("gray")
-    id_to_rg = np.array([[200, 0, 0], [0, 250, 0]])
+    id_to_rg = _ID_TO_RG
+    
+    # predict all samples in a single forward pass
+    samples = [dataSet[sampleID] for sampleID in testSamples]
+    inputImages = torch.stack([sample[0] for sample in samples]).to(device)
+    gts = torch.stack([sample[1] for sample in samples]).numpy()
+    with torch.inference_mode():
+        preds = torch.argmax(model(inputImages), dim=1).cpu().numpy()
+        # input rgb images
+        if norm_dataset: 
+            inputImages = inverse_transform(norm_dataset)(inputImages)
+        landscapes = inputImages.permute(0, 2, 3, 1).cpu().numpy()
     
     for i, sampleID in enumerate(testSamples):
-        inputImage, gt = dataSet[sampleID]
-
         # input rgb image   
-        inputImage = inputImage.to(device)
-        if norm_dataset: 
-            inv_norm = inverse_transform(norm_dataset)
-            landscape = inv_norm(inputImage).permute(1, 2, 0).cpu().detach().numpy()
-        else: 
-            landscape = inputImage.permute(1, 2, 0).cpu().detach().numpy()
-        axes[i, 0].imshow(landscape)
+        axes[i, 0].imshow(landscapes[i])
         axes[i, 0].set_title(dataSet.get_name(sampleID))
 
         # groundtruth label image
-        label_class = gt.cpu().detach().numpy()
+        label_class = gts[i]
         axes[i, 1].imshow(id_to_color[label_class])
         axes[i, 1].set_title("Groundtruth Label")
 
         # predicted label image
-        y_pred = torch.argmax(model(inputImage.unsqueeze(0)), dim=1).squeeze(0)
-        label_class_predicted = y_pred.cpu().detach().numpy()    
+        label_class_predicted = preds[i]
         axes[i, 2].imshow(id_to_color[label_class_predicted])
         axes[i, 2].legend(handles=legend_elements, loc = 'upper left', bbox_to_anchor=(-0.7, 0.9))
         axes[i, 2].set_title("Prediction "+model_label)
 
         # difference groundtruth and prediction
         diff = label_class == label_class_predicted
-        axes[i, 3].imshow(id_to_rg[diff*1])#, cmap = rgcmap) # make int to map 0 and 1 to cmap, otherwise a 
-        axes[i, 3].legend(handles=diff_legend)
+        axes[i, 3].imshow(id_to_rg[diff.astype(np.uint8, copy=False)])#, cmap = rgcmap) # make int to map 0 and 1 to cmap, otherwise a 
+        axes[i, 3].legend(handles=_diff_legend())
         axes[i, 3].set_title("Correctness "+model_label)
         # print(diff*1)
         # issue (solved?): if the whole image is predicted wrong, it is visualized green (probably because imshow simply takes first color from cmap?)
@@ -552,6 +874,8 @@ def compare_models_onOneImage(model1 : torch.nn.Module,
         model_label2 (String) : text that should be added to the figure title for the second model
         plot_title (String) : title of the whole figure
     """
+    import matplotlib.pyplot as plt
+
     _, axes = plt.subplots(2, 3, figsize=(4*5, 3 * 3))
     
     if plot_title:
@@ -578,7 +902,7 @@ def compare_models_onOneImage(model1 : torch.nn.Module,
     for handle in legend_elements:
         if handle.get_label() == 'Impervious':
             handle.set_edgecolor("gray")
-    id_to_rg = np.array([[200, 0, 0], [0, 250, 0]])
+    id_to_rg = _ID_TO_RG
 
     # input rgb image   
     inputImage = inputImage.to(device)
@@ -603,7 +927,7 @@ def compare_models_onOneImage(model1 : torch.nn.Module,
 
     # difference groundtruth and prediction
     diff = label_class == label_class_predicted1
-    axes[0, 2].imshow(id_to_rg[diff*1])#, cmap = rgcmap) # make int to map 0 and 1 to cmap, otherwise a 
+    axes[0, 2].imshow(id_to_rg[diff.astype(np.uint8, copy=False)])#, cmap = rgcmap) # make int to map 0 and 1 to cmap, otherwise a 
     axes[0, 2].set_title("Correctness "+model1_label)
     
     # predicted label image
@@ -615,8 +939,8 @@ def compare_models_onOneImage(model1 : torch.nn.Module,
 
     # difference groundtruth and prediction
     diff = label_class == label_class_predicted2
-    axes[1, 2].imshow(id_to_rg[diff*1])#, cmap = rgcmap) # make int to map 0 and 1 to cmap, otherwise a 
-    axes[1, 2].legend(handles=diff_legend, loc = 'upper left', bbox_to_anchor=(-0.5, 1.2))
+    axes[1, 2].imshow(id_to_rg[diff.astype(np.uint8, copy=False)])#, cmap = rgcmap) # make int to map 0 and 1 to cmap, otherwise a 
+    axes[1, 2].legend(handles=_diff_legend(), loc = 'upper left', bbox_to_anchor=(-0.5, 1.2))
     axes[1, 2].set_title("Correctness "+model2_label)
     
     for ax in axes.reshape(-1): 
@@ -639,31 +963,75 @@ from torch.utils.data import Dataset as BaseDataset
 
 
 # Now replace RGB to integer values to be used as labels.
-#Find pixels with combination of RGB for the above defined arrays...
-#if matches then replace all values in that pixel with a specific integer
-def rgb_to_2D_label(label):
+# Colors of the ISPRS label masks in RGB order, the position in the list is the class id
+ISPRS_COLORS = [
+    (255, 255, 255), # Impervious
+    (0, 0, 255),     # Building
+    (0, 255, 255),   # Vegetation
+    (0, 255, 0),     # Tree
+    (255, 255, 0),   # Car
+    (255, 0, 0),     # Clutter
+]
+
+def _pack_colors(label):
+    """ Pack the three uint8 channels of an image into one uint32 per pixel (c0<<16 | c1<<8 | c2) """
+    return (label[..., 0].astype(np.uint32) << 16) | (label[..., 1].astype(np.uint32) << 8) | label[..., 2]
+
+def _build_color_lut(colors):
+    """ Build sorted arrays of packed colors and the corresponding class ids to look up with np.searchsorted """
+    lut = {(c0 << 16) | (c1 << 8) | c2: class_id for class_id, (c0, c1, c2) in enumerate(colors)}
+    keys = np.array(sorted(lut), dtype=np.uint32)
+    values = np.array([lut[k] for k in keys], dtype=np.uint8)
+    return keys, values
+
+RGB_LUT = _build_color_lut(ISPRS_COLORS)
+
+def rgb_to_2D_label(label, lut=RGB_LUT):
     """
     Suply our label masks as input in RGB format. 
-    Replace pixels with specific RGB values ...
+    Replace pixels with specific RGB values by their class id in one pass
+    over the packed pixel values. Pixels with unknown colors get class 0.
+    Pass a lut built with the channels in BGR order to map masks as read by cv2.
+    Returns a 2D (HxW) uint8 array.
     """
-    Impervious = [255, 255, 255]
-    Building = [0, 0, 255]
-    Vegetation = [0, 255, 255]
-    Tree = [0, 255, 0]
-    Car = [255, 255, 0]
-    Clutter = [255, 0, 0]
+    keys, values = lut
+    if _pack_and_map is not None:
+        return _pack_and_map(np.ascontiguousarray(label), keys, values)
+    packed = _pack_colors(label).ravel()
+    idx = np.searchsorted(keys, packed)
+    # searchsorted returns len(keys) for values larger than the last key
+    np.minimum(idx, len(keys) - 1, out=idx)
+    label_seg = np.where(keys[idx] == packed, values[idx], 0).astype(np.uint8)
+    
+    return label_seg.reshape(label.shape[:2])
 
-    label_seg = np.zeros(label.shape,dtype=np.uint8)
-    label_seg [np.all(label==Impervious,axis=-1)] = 0
-    label_seg [np.all(label==Building,axis=-1)] = 1
-    label_seg [np.all(label==Vegetation,axis=-1)] = 2
-    label_seg [np.all(label==Tree,axis=-1)] = 3
-    label_seg [np.all(label==Car,axis=-1)] = 4
-    label_seg [np.all(label==Clutter,axis=-1)] = 5
 
-    # label_seg = label_seg[:,:,0]  #Just take the first channel, no need for all 3 channels
-    
-    return label_seg
+
+def _scan_ids(directory):
+    """ Sorted names of the files in directory; one scandir call, subdirectories (e.g. .ipynb_checkpoints) are skipped """
+    with os.scandir(directory) as entries:
+        return sorted(entry.name for entry in entries if entry.is_file())
+
+
+# cv2 flags to decode images at 1/8, 1/4 or 1/2 of their resolution
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+def _decode_flag(fp, dims):
+    """ Get the cv2.imread flag that decodes the image at the lowest resolution still at least as large as dims. 
+    Only JPEGs are decoded at reduced size, other formats (e.g. TIFF) would be decoded fully and shrunk 
+    with aliasing, so they are read at full size and resized with INTER_AREA in Dataset._load """
+    try:
+        # PIL only reads the header here
+        with Image.open(fp) as im:
+            if im.format != 'JPEG':
+                return cv2.IMREAD_COLOR
+            width, height = im.size
+    except OSError:
+        return cv2.IMREAD_COLOR
+    for factor, flag in _REDUCED_FLAGS:
+        if width // factor >= dims[0] and height // factor >= dims[1]:
+            return flag
+    return cv2.IMREAD_COLOR
 
 
 
@@ -675,14 +1043,25 @@ class Dataset(BaseDataset):
         masks_dir (str): path to segmentation masks folder
         class_values (list): values of classes to extract from segmentation mask
         augmentation (albumentations.Compose): data transfromation pipeline 
-            (e.g. flip, scale, etc.)
+            (e.g. flip, scale, etc.), applied to image and mask; 
+            any other callable (e.g. torchvision transforms) is applied to the image only, as PIL image
         preprocessing (albumentations.Compose): data preprocessing 
             (e.g. noralization, shape manipulation, etc.)
+        in_memory (bool): decode, resize and label-map all samples once in __init__ and keep them in RAM
+        cache_dir (str): if given, decode, resize and label-map all samples once into .npy files in this directory 
+            and read them memory mapped; the files are reused by later runs with the same directories, files, 
+            classes and patch size
+        normalize_on_device (bool): return uint8 3xHxW RGB images and leave scaling and normalization to the 
+            device, CudaPrefetcher does this for batches of such datasets after the copy
     
     """
     
     # CLASSES = ['impervious', 'building', 'vegetation', 'tree', 'car', 'clutter']
     
+    # label lookup tables, built once per process and shared by all instances (never modify them); 
+    # the normalization arrays are shared through _NORM_LUTS
+    _CACHE = {}
+    
     def __init__(
             self, 
             images_dir, 
@@ -691,77 +1070,205 @@ class Dataset(BaseDataset):
             augmentation=None, 
             normalization=False,
             patch_size=512,
-            dataset=None
+            dataset=None,
+            in_memory=False,
+            cache_dir=None,
+            normalize_on_device=False
     ):
-        self.im_ids = sorted(os.listdir(images_dir))
+        self.im_ids = _scan_ids(images_dir)
         # self.im_ids = list(filter(lambda x: x.endswith('11_RGB.tif'), self.im_ids))
+        self._id_index = {name: i for i, name in enumerate(self.im_ids)}
         self.images_fps = [os.path.join(images_dir, image_id) for image_id in self.im_ids]
-        self.mask_ids = sorted(os.listdir(masks_dir))
+        self.mask_ids = _scan_ids(masks_dir)
         # self.mask_ids = list(filter(lambda x: x.endswith('11_label.tif'), self.mask_ids))
         self.masks_fps = [os.path.join(masks_dir, mask_id) for mask_id in self.mask_ids]
         self.CLASSES = classes
         
         self.dims = (patch_size, patch_size)
+        # decode images that are much larger than the patch size at reduced resolution; 
+        # if all samples are decoded once into memory or a cache, the flag is looked up in _load instead
+        self._decode_flags = None
+        if cache_dir is None and not in_memory:
+            self._decode_flags = [_decode_flag(fp, self.dims) for fp in self.images_fps]
+        
+        # lookup tables are shared by all datasets with the same classes / normalization, see _CACHE
+        self._bgr_lut, self._mask_lut = self._cached(('labels', len(classes)), lambda: self._label_luts(len(classes)))
         
         # convert str names to class values on masks
         self.class_values = [self.CLASSES.index(cls) for cls in classes]
         
         self.augmentation = augmentation
         self.normalization = normalization
-        if normalization:
-            self.normalize = normalize_images(dataset)
+        self.normalize_on_device = normalize_on_device
+        # per channel values to convert uint8 images to normalized float tensors in one step, 
+        # replaces ToTensor (scaling to [0, 1]) followed by Normalize
+        stats = _NORM_STATS.get(dataset, _DEFAULT_NORM_STATS) if normalization else _IDENTITY_NORM_STATS
+        self._mean, self._std = stats
+        self._mean_f32, self._inv_std_f32, self._norm_lut = _norm_luts(stats)
+        self._lut_channels = self._cached('lut_channels', lambda: np.arange(3).reshape(3, 1, 1))
+        
+        # decode all samples once, __getitem__ then only slices these arrays
+        self.images, self.masks = None, None
+        if cache_dir is not None:
+            self.images, self.masks = self._materialize_cache(cache_dir, images_dir, masks_dir)
+        elif in_memory:
+            self.images = np.empty((len(self), patch_size, patch_size, 3), dtype=np.uint8) # BGR
+            self.masks = np.empty((len(self), patch_size, patch_size), dtype=np.uint8)
+            for i in tqdm(range(len(self)), desc='load samples into memory'):
+                self.images[i], self.masks[i] = self._load(i)
             
     
     def __getitem__(self, i):
         
         # read data
-        # print(self.images_fps[i])
-        # print(self.masks_fps[i])
-        image = cv2.imread(self.images_fps[i])
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        image = cv2.resize(image, self.dims, interpolation=cv2.INTER_NEAREST)
-        mask = cv2.imread(self.masks_fps[i])
-        mask = cv2.cvtColor(mask, cv2.COLOR_BGR2RGB) # cv2 reads image as BGR, change to RGB
-        mask = cv2.resize(mask, self.dims, interpolation=cv2.INTER_NEAREST)
-        # (print(np.unique(mask)))
-        if len(self.CLASSES) == 6:
-            mask = rgb_to_2D_label(mask)
-        mask = mask[:,:,0]
-        
-        # else:
-        #     mask = mask[:,:,0]
-        
-        # print(self.images_fps[i])
+        if self.images is not None:
+            image, mask = self.images[i], self.masks[i]
+        else:
+            image, mask = self._load(i)
         
         # # extract certain classes from mask (e.g. cars)
         # masks = [(mask == v) for v in self.class_values]
         # mask = np.stack(masks, axis=-1).astype('float')
         # if len(self.class_values) < len(self.CLASSES):
         #     mask = np.c_[np.zeros((np.shape(mask)[0], np.shape(mask)[1], 1)), mask] # add column to make everything not in selected classes background
-        mask = torch.from_numpy(mask).long()
         
         # # apply augmentations
+        bgr = True
         if self.augmentation:
-            # sample = self.augmentation(image=image, mask=mask)
-            # image, mask = sample['image'], sample['mask']
-            image = Image.fromarray(image)
-            image = self.augmentation(image)
+            # color transforms expect RGB
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            bgr = False
+            if A is not None and isinstance(self.augmentation, (A.BasicTransform, A.BaseCompose)):
+                # albumentations
+                sample = self.augmentation(image=image, mask=mask)
+                image, mask = sample['image'], sample['mask']
+            else:
+                # torchvision transforms or any other callable on PIL images
+                image = np.asarray(self.augmentation(Image.fromarray(image)))
+        # single copy to a contiguous int64 array, the dtype the losses expect
+        mask = torch.from_numpy(mask.astype(np.int64))
         
-        # apply preprocessing
-        image = preprocess(image)
-        if self.normalization:
-            image = self.normalize(image)
+        # apply preprocessing and normalization
+        image = self._to_tensor(image, bgr)
             
         return image, mask
+
+    @classmethod
+    def _cached(cls, key, build):
+        """ Return the arrays stored under key in _CACHE, build them on first use """
+        if key not in cls._CACHE:
+            cls._CACHE[key] = build()
+        return cls._CACHE[key]
+
+    @staticmethod
+    def _label_luts(num_classes):
+        """ Lookup tables from the BGR mask colors and from single channel mask values to class ids """
+        # cv2 reads masks as BGR, so match the label colors in BGR order instead of converting every mask
+        bgr_lut = _build_color_lut([color[::-1] for color in ISPRS_COLORS])
+        # single channel masks (e.g. FloodNet) already store class ids; values that are no class id are mapped to 0, 
+        # like unknown colors in rgb_to_2D_label, so all labels are in [0, num_classes)
+        mask_lut = np.zeros(256, dtype=np.uint8)
+        mask_lut[:num_classes] = np.arange(num_classes)
+        return bgr_lut, mask_lut
+
+    def _materialize_cache(self, cache_dir, images_dir, masks_dir):
+        """ Write all decoded samples to one image (NxHxWx3, BGR) and one mask (NxHxW) .npy file 
+        and return them memory mapped; existing files are reused if they were written for the same 
+        image and mask directories, number of classes and patch size and list the same files """
+        os.makedirs(cache_dir, exist_ok=True)
+        source = f"{os.path.abspath(images_dir)}\n{os.path.abspath(masks_dir)}\n{len(self.CLASSES)}"
+        digest = hashlib.sha1(source.encode()).hexdigest()[:12]
+        prefix = os.path.join(cache_dir, f"{os.path.basename(os.path.normpath(images_dir))}_{self.dims[0]}px_{digest}")
+        images_path, masks_path, ids_path = f"{prefix}_images.npy", f"{prefix}_masks.npy", f"{prefix}_ids.txt"
+        # the sorted file names of images and masks in sample order, stored next to the arrays
+        ids = '\n'.join(self.im_ids + self.mask_ids) + '\n'
+        shape = (len(self), self.dims[1], self.dims[0])
+        if os.path.exists(images_path) and os.path.exists(masks_path) and os.path.exists(ids_path):
+            with open(ids_path) as f:
+                cached_ids = f.read()
+            # copy on write, so the arrays are writable without changing the files
+            images = np.load(images_path, mmap_mode='c')
+            masks = np.load(masks_path, mmap_mode='c')
+            if cached_ids == ids and images.shape == shape + (3,) and masks.shape == shape:
+                return images, masks
+        # write to temporary files first, so an interrupted run does not leave an incomplete cache
+        if os.path.exists(ids_path):
+            os.remove(ids_path)
+        images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8, shape=shape + (3,))
+        masks = np.lib.format.open_memmap(masks_path + '.tmp', mode='w+', dtype=np.uint8, shape=shape)
+        for i in tqdm(range(len(self)), desc=f'write cache {prefix}'):
+            images[i], masks[i] = self._load(i)
+        images.flush()
+        masks.flush()
+        del images, masks
+        os.replace(images_path + '.tmp', images_path)
+        os.replace(masks_path + '.tmp', masks_path)
+        # written last, so the arrays are only reused once both are complete
+        with open(ids_path + '.tmp', 'w') as f:
+            f.write(ids)
+        os.replace(ids_path + '.tmp', ids_path)
+        return np.load(images_path, mmap_mode='c'), np.load(masks_path, mmap_mode='c')
+
+    def _load(self, i):
+        """ Read sample i from disk, returns the resized BGR uint8 image and the uint8 class id mask """
+        # print(self.images_fps[i])
+        # print(self.masks_fps[i])
+        flag = self._decode_flags[i] if self._decode_flags is not None else _decode_flag(self.images_fps[i], self.dims)
+        image = cv2.imread(self.images_fps[i], flag) # BGR, swapped to RGB in _to_tensor
+        if image.shape[1::-1] != self.dims:
+            # area averaging avoids aliasing when downscaling, upscaling uses bilinear interpolation; 
+            # masks keep nearest neighbour below
+            downscale = image.shape[0] >= self.dims[1] and image.shape[1] >= self.dims[0]
+            image = cv2.resize(image, self.dims, interpolation=cv2.INTER_AREA if downscale else cv2.INTER_LINEAR)
+        # (print(np.unique(mask)))
+        if len(self.CLASSES) == 6:
+            mask = cv2.imread(self.masks_fps[i]) # kept in BGR order, see self._bgr_lut
+        else:
+            mask = cv2.imread(self.masks_fps[i], cv2.IMREAD_GRAYSCALE)
+        # nearest neighbour resizing commutes with the per pixel mapping, so map at the smaller size: 
+        # larger masks are shrunk first, smaller ones are enlarged as single channel label image after mapping
+        if mask.shape[0] * mask.shape[1] > self.dims[0] * self.dims[1]:
+            mask = cv2.resize(mask, self.dims, interpolation=cv2.INTER_NEAREST)
+        if mask.ndim == 3:
+            mask = rgb_to_2D_label(mask, lut=self._bgr_lut)
+        else:
+            mask = cv2.LUT(mask, self._mask_lut)
+        if mask.shape[1::-1] != self.dims:
+            mask = cv2.resize(mask, self.dims, interpolation=cv2.INTER_NEAREST)
+        return image, mask
+
+    def _to_tensor(self, image, bgr=True):
+        """ Convert a HxWx3 image to a normalized, contiguous 3xHxW float tensor. 
+        For uint8 images channel swap, transpose, cast and normalization are a single lookup in self._norm_lut, 
+        other dtypes are cast while subtracting the mean and scaled in place. 
+        With normalize_on_device uint8 images are only transposed to RGB 3xHxW """
+        if self.normalize_on_device and image.dtype == np.uint8:
+            # a quarter of the bytes to collate, pin and copy; normalized in CudaPrefetcher
+            chw = image.transpose(2, 0, 1)
+            if bgr:
+                chw = chw[::-1]
+            return torch.from_numpy(np.ascontiguousarray(chw))
+        if _normalize_nb is not None and image.dtype == np.uint8:
+            # one pass over the pixels; the output is allocated per sample, 
+            # a reused buffer would be shared by all samples of a batch before collation
+            out = np.empty((3,) + image.shape[:2], dtype=np.float32)
+            _normalize_nb(image, self._norm_lut, bgr, out)
+            return torch.from_numpy(out)
+        chw = image.transpose(2, 0, 1)
+        if bgr:
+            chw = chw[::-1]
+        if chw.dtype == np.uint8:
+            return torch.from_numpy(self._norm_lut[self._lut_channels, chw])
+        out = np.empty(chw.shape, dtype=np.float32)
+        np.subtract(chw, self._mean_f32, out=out)
+        out *= self._inv_std_f32
+        return torch.from_numpy(out)
     
     def get_name(self, i):
         return self.im_ids[i]
     
     def get_id_by_name(self, im_name):
-        for i, name in enumerate(self.im_ids):    
-            if name == im_name:
-                return i
-        return 
+        return self._id_index.get(im_name)
         
     def __len__(self):
         return len(self.im_ids)
@@ -770,24 +1277,30 @@ class Dataset(BaseDataset):
 def load_datasets(
         data_dir : str, 
         random_split : bool = True, 
-        augmentation : torch.nn.Sequential = None, 
+        augmentation = None, 
         normalize : bool = True, 
         classes : str = 'potsdam', 
         patch_size : int = 512, 
         only_test : bool = False, 
-        dataset : str = 'potsdam'
+        dataset : str = 'potsdam',
+        in_memory : bool = False,
+        cache_dir : str = None,
+        normalize_on_device : bool = False
         ):
     """Load and prepare datasets
 
     Args:
         data_dir (str): path to data, must be split into subdirs /rgb, /label, /rgb_test, /rgb_label
         random_split (bool, optional): True splits the train and validation data randomly. If false it is necessary to add subdirs /rgb_valid and /label_valid. Defaults to True.
-        augmentation (torch.nn.Sequential, optional): Augmenation settings. Defaults to None.
+        augmentation (albumentations.Compose, optional): Augmenation settings, e.g. utils.augmentation; torchvision transforms or other callables on PIL images are supported as well. Defaults to None.
         normalize (bool, optional): If true, apply normalization corresponding to parameter dataset. Defaults to True.
         classes (str, optional): Classes that correspond to the dataset. Choose between 'potsdam' and 'floodnet'. Defaults to 'potsdam'.
         patch_size (int, optional): Patch size that the images are resized to. Defaults to 512.
         only_test (bool, optional): If true, only return the test dataset. Defaults to False.
         dataset (str, optional): Dataset used for normalization. Choose from one of 'imagenet', 'potsdam', 'potsdam_irrg', 'floodnet', 'vaihingen'. Defaults to 'potsdam'.
+        in_memory (bool, optional): If true, decode all samples once and keep them in RAM instead of reading them from disk every epoch. Defaults to False.
+        cache_dir (str, optional): If given, decode all samples once into memory mapped .npy files in this directory, which are reused by later runs. Takes precedence over in_memory. Defaults to None.
+        normalize_on_device (bool, optional): If true, the training and validation datasets return uint8 images that are normalized on the device by CudaPrefetcher. The test dataset is always normalized on the cpu, because the visualization functions index it directly. Defaults to False.
 
     Returns:
         Dataset: Either only the test dataset or training dataset, validation dataset, test dataset
@@ -799,79 +1312,213 @@ def load_datasets(
     if classes == 'floodnet':
         CLASSES = ['Background', 'Building-flooded', 'Building-non-flooded', 'Road-flooded', 'Road-non-flooded', 'Water', 'Tree', 'Vehicle', 'Pool', 'Grass']
     
+    def _make_dataset(images_dir, masks_dir, on_device):
+        return Dataset(
+            images_dir, 
+            masks_dir, 
+            augmentation=augmentation, 
+            normalization=normalize,
+            classes=CLASSES,
+            patch_size=patch_size,
+            dataset=dataset,
+            in_memory=in_memory,
+            cache_dir=cache_dir,
+            normalize_on_device=on_device
+        )
+    
     x_test_dir = os.path.join(data_dir, 'rgb_test')
     y_test_dir = os.path.join(data_dir, 'label_test')
 
-    test_dataset = Dataset(
-        x_test_dir, 
-        y_test_dir, 
-        # augmentation=get_validation_augmentation(), 
-        augmentation=augmentation, 
-        normalization=normalize,
-        classes=CLASSES,
-        patch_size=patch_size,
-        dataset=dataset
-    )
+    test_dataset = _make_dataset(x_test_dir, y_test_dir, on_device=False)
     
     if only_test:
         return test_dataset        
     
+    x_train_dir = os.path.join(data_dir, 'rgb')
+    y_train_dir = os.path.join(data_dir, 'label')
+    
     # use train directory as input for training and validation data and split them randomly in two subsets
     if random_split: 
-        x_train_dir = os.path.join(data_dir, 'rgb')
-        y_train_dir = os.path.join(data_dir, 'label')
-        
-        training_dataset = Dataset(
-            x_train_dir, 
-            y_train_dir, 
-            augmentation=augmentation, 
-            normalization=normalize,
-            classes=CLASSES,
-            patch_size=patch_size,
-            dataset=dataset
-        )
+        training_dataset = _make_dataset(x_train_dir, y_train_dir, on_device=normalize_on_device)
 
+        # same permutation as torch.utils.data.random_split with this generator, so the split is unchanged
         generator = torch.Generator().manual_seed(42)
-        train_dataset, valid_dataset = torch.utils.data.random_split(training_dataset, [math.floor(0.75*len(training_dataset)), math.ceil(0.25*len(training_dataset))], generator=generator)
+        n = len(training_dataset)
+        k = (3 * n) // 4 # train size, integer arithmetic so k + (n - k) == n for every n
+        perm = torch.randperm(n, generator=generator)
+        train_dataset = torch.utils.data.Subset(training_dataset, perm[:k].tolist())
+        valid_dataset = torch.utils.data.Subset(training_dataset, perm[k:].tolist())
         
     else:
-        
-        x_train_dir = os.path.join(data_dir, 'rgb')
-        y_train_dir = os.path.join(data_dir, 'label')
-
         x_valid_dir = os.path.join(data_dir, 'rgb_valid')
         y_valid_dir = os.path.join(data_dir, 'label_valid')
 
-        train_dataset = Dataset(
-            x_train_dir, 
-            y_train_dir, 
-            # augmentation=get_training_augmentation(), 
-            augmentation=augmentation, 
-            normalization=normalize,
-            classes=CLASSES,
-            patch_size=patch_size,
-            dataset=dataset
-        )
-
-        valid_dataset = Dataset(
-            x_valid_dir, 
-            y_valid_dir, 
-            # augmentation=get_validation_augmentation(), 
-            augmentation=augmentation, 
-            normalization=normalize,
-            classes=CLASSES,
-            patch_size=patch_size,
-            dataset=dataset
-        )
+        train_dataset = _make_dataset(x_train_dir, y_train_dir, on_device=normalize_on_device)
+        valid_dataset = _make_dataset(x_valid_dir, y_valid_dir, on_device=normalize_on_device)
         
 
     return train_dataset, valid_dataset, test_dataset
 
 
-def make_loader(train_set, val_set, test_set, train_batch=4, val_batch=2, train_worker=0, val_worker=0):
+def default_num_workers():
+    """ Number of dataloader workers per GPU based on the available cpus, between 2 and 8 """
+    return min(8, max(2, (os.cpu_count() or 2) // max(1, torch.cuda.device_count())))
+
+
+def _seed_worker(worker_id):
+    """ Seed numpy and random in each dataloader worker from its torch seed, which differs between workers 
+    (and epochs), otherwise the workers draw the same numpy random augmentations """
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def make_loader(train_set, val_set, test_set, train_batch=4, val_batch=2, train_worker=None, val_worker=None, 
+                pin_memory : bool = True, persistent_workers : bool = True, prefetch_factor : int = 4):
+    """Create dataloaders for training, validation and test data
+
+    Batches are returned in pinned memory (if cuda is available and pin_memory is true), 
+    so they can be copied to the GPU asynchronously with tensor.to(device, non_blocking=True), as done by CudaPrefetcher.
+
+    Args:
+        train_set, val_set, test_set (Dataset): datasets as returned by load_datasets
+        train_batch (int, optional): batch size for training data. Defaults to 4.
+        val_batch (int, optional): batch size for validation and test data. Defaults to 2.
+        train_worker (int, optional): number of workers for training data. Defaults to None, i.e. default_num_workers().
+        val_worker (int, optional): number of workers for validation and test data. Defaults to None, i.e. default_num_workers().
+        pin_memory (bool, optional): If true and cuda is available, load batches into pinned memory. Defaults to True.
+        persistent_workers (bool, optional): If true, keep the workers alive between epochs instead of respawning them. Only used with workers. Defaults to True.
+        prefetch_factor (int, optional): number of batches loaded in advance by each worker. Only used with workers. Defaults to 4.
+
+    Returns:
+        DataLoader: training, validation and test dataloader
+    """
+    pin_memory = pin_memory and torch.cuda.is_available()
+    if train_worker is None:
+        train_worker = default_num_workers()
+    if val_worker is None:
+        val_worker = default_num_workers()
+
+    def worker_kwargs(num_workers):
+        # persistent_workers and prefetch_factor are only valid with worker processes
+        if num_workers > 0:
+            return {'persistent_workers': persistent_workers, 'prefetch_factor': prefetch_factor, 'worker_init_fn': _seed_worker}
+        return {}
+
+    train_loader = DataLoader(train_set, batch_size=train_batch, shuffle=True, num_workers=train_worker, 
+                              pin_memory=pin_memory, **worker_kwargs(train_worker))
+    valid_loader = DataLoader(val_set, batch_size=val_batch, shuffle=False, num_workers=val_worker, 
+                              pin_memory=pin_memory, **worker_kwargs(val_worker))
+    test_loader = DataLoader(test_set, batch_size=val_batch, shuffle=False, num_workers=val_worker, 
+                             pin_memory=pin_memory, **worker_kwargs(val_worker))
+    
+    return train_loader, valid_loader, test_loader
+
+
+
+#######################################
+# GPU data loading with NVIDIA DALI (optional)
+#######################################
 
-    train_loader = DataLoader(train_set, batch_size=train_batch, shuffle=True, num_workers=train_worker)
-    valid_loader = DataLoader(val_set, batch_size=val_batch, shuffle=False, num_workers=val_worker)
-    test_loader = DataLoader(test_set, batch_size=val_batch, shuffle=False, num_workers=val_worker)
+def _file_lists(dataset):
+    """ Get image and mask file paths and the Dataset object of a Dataset or a Subset of it """
+    if isinstance(dataset, torch.utils.data.Subset):
+        base = dataset.dataset
+        return [base.images_fps[i] for i in dataset.indices], [base.masks_fps[i] for i in dataset.indices], base
+    return dataset.images_fps, dataset.masks_fps, dataset
+
+
+class DaliLoader:
+    """ Iterates a DALI pipeline like a DataLoader; yields (images, masks) on the GPU, 
+    with images normalized as float 3xHxW and masks mapped to class ids as long HxW """
+    def __init__(self, pipeline, num_samples, batch_size, num_classes):
+        from nvidia.dali.plugin.pytorch import DALIGenericIterator, LastBatchPolicy
+        self.iterator = DALIGenericIterator(pipeline, ['image', 'mask'], reader_name='images', 
+                                            last_batch_policy=LastBatchPolicy.PARTIAL, auto_reset=True)
+        self.num_batches = math.ceil(num_samples / batch_size)
+        self.num_classes = num_classes
+        self._keys = [(c0 << 16) | (c1 << 8) | c2 for c0, c1, c2 in ISPRS_COLORS]
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        for batch in self.iterator:
+            images, masks = batch[0]['image'], batch[0]['mask']
+            if self.num_classes == 6:
+                # same mapping as rgb_to_2D_label, masks are decoded as RGB
+                masks = masks.int()
+                packed = (masks[..., 0] << 16) | (masks[..., 1] << 8) | masks[..., 2]
+                labels = torch.zeros(packed.shape, dtype=torch.long, device=packed.device)
+                for class_id, key in enumerate(self._keys):
+                    labels.masked_fill_(packed == key, class_id)
+            else:
+                # values that are no class id become 0, like Dataset._mask_lut on the cpu
+                labels = masks[..., 0].long()
+                labels = torch.where(labels < self.num_classes, labels, torch.zeros_like(labels))
+            yield images, labels
+
+
+def make_loader_dali(train_set, val_set, test_set, train_batch=4, val_batch=2, num_threads=None, device_id=0, seed=42):
+    """Create loaders that decode, resize, augment and normalize the data on the GPU with NVIDIA DALI. 
+    Falls back to make_loader if DALI or a cuda device is not available.
+
+    Augmentation is applied to the training data if its Dataset has an augmentation set; 
+    DALI cannot run albumentations pipelines, so the color jitter of utils.augmentation is reproduced with fn.color_twist.
+
+    Args:
+        train_set, val_set, test_set (Dataset): datasets as returned by load_datasets
+        train_batch (int, optional): batch size for training data. Defaults to 4.
+        val_batch (int, optional): batch size for validation and test data. Defaults to 2.
+        num_threads (int, optional): number of cpu threads of each pipeline. Defaults to None, i.e. default_num_workers().
+        device_id (int, optional): id of the GPU to run the pipelines on. Defaults to 0.
+        seed (int, optional): seed for shuffling and augmentation. Defaults to 42.
+
+    Returns:
+        DaliLoader: training, validation and test loader
+    """
+    try:
+        from nvidia.dali import pipeline_def, fn, types
+    except ImportError:
+        print('NVIDIA DALI is not installed, use make_loader instead')
+        return make_loader(train_set, val_set, test_set, train_batch, val_batch)
+    if not torch.cuda.is_available():
+        print('DALI needs a cuda device, use make_loader instead')
+        return make_loader(train_set, val_set, test_set, train_batch, val_batch)
+    if num_threads is None:
+        num_threads = default_num_workers()
+
+    @pipeline_def
+    def segmentation_pipeline(image_files, mask_files, patch_size, mean, std, shuffle, augment):
+        # both readers shuffle with the same seed, so images and masks stay paired
+        images, _ = fn.readers.file(files=image_files, random_shuffle=shuffle, seed=seed, name='images')
+        masks, _ = fn.readers.file(files=mask_files, random_shuffle=shuffle, seed=seed)
+        images = fn.decoders.image(images, device='mixed', output_type=types.RGB)
+        masks = fn.decoders.image(masks, device='mixed', output_type=types.RGB)
+        images = fn.resize(images, resize_x=patch_size, resize_y=patch_size, interp_type=types.INTERP_LINEAR)
+        masks = fn.resize(masks, resize_x=patch_size, resize_y=patch_size, interp_type=types.INTERP_NN, antialias=False)
+        if augment:
+            # same ranges as utils.augmentation (ColorJitter(brightness=0.5, contrast=1, saturation=0.1, hue=0.5))
+            images = fn.color_twist(images, 
+                                    brightness=fn.random.uniform(range=[0.5, 1.5]), 
+                                    contrast=fn.random.uniform(range=[0.0, 2.0]), 
+                                    saturation=fn.random.uniform(range=[0.9, 1.1]), 
+                                    hue=fn.random.uniform(range=[-180.0, 180.0]))
+        images = fn.crop_mirror_normalize(images, dtype=types.FLOAT, output_layout='CHW', mean=mean, std=std)
+        return images, masks
+
+    def build(dataset, batch_size, shuffle):
+        image_files, mask_files, base = _file_lists(dataset)
+        mean = (255 * base._mean).tolist()
+        std = (255 * base._std).tolist()
+        augment = shuffle and base.augmentation is not None
+        pipe = segmentation_pipeline(image_files, mask_files, base.dims[0], mean, std, shuffle, augment, 
+                                     batch_size=batch_size, num_threads=num_threads, device_id=device_id, seed=seed)
+        pipe.build()
+        return DaliLoader(pipe, len(image_files), batch_size, len(base.CLASSES))
+
+    train_loader = build(train_set, train_batch, shuffle=True)
+    valid_loader = build(val_set, val_batch, shuffle=False)
+    test_loader = build(test_set, val_batch, shuffle=False)
     
-    return train_loader, valid_loader, test_loader
\ No newline at end of file
+    return train_loader, valid_loader, test_loader